@@ -3,10 +3,17 @@ from wsgiref.simple_server import make_server
 
 import torch
 import torch.nn as nn
-from torch.nn.functional import log_softmax
+import torch.nn.functional as F
+from torch.nn.attention import SDPBackend, sdpa_kernel
 
 from utils import clones
 
+try:
+    # Single fused CUDA kernel, used when NVIDIA apex is installed.
+    from apex.normalization.fused_layer_norm import fused_layer_norm_affine
+except ImportError:
+    fused_layer_norm_affine = None
+
 
 class LayerNorm(nn.Module):
     "Construct a layernorm module - https://arxiv.org/abs/1607.06450"
@@ -18,9 +25,15 @@ class LayerNorm(nn.Module):
         self.eps = eps
 
     def forward(self, x):
-        mean = x.mean(-1, keepdim=True)
-        std = x.std(-1, keepdim=True)
-        return self.a_2 * (x - mean) / (std + self.eps) + self.b_2
+        normalized_shape = self.a_2.shape
+        if fused_layer_norm_affine is not None and x.is_cuda:
+            # apex follows the autocast dtype; keep it in fp32 like F.layer_norm
+            with torch.autocast(device_type="cuda", enabled=False):
+                return fused_layer_norm_affine(
+                    x.float(), self.a_2.float(), self.b_2.float(),
+                    normalized_shape, self.eps
+                )
+        return F.layer_norm(x, normalized_shape, self.a_2, self.b_2, self.eps)
     
     
 class SublayerConnection(nn.Module):
@@ -34,9 +47,9 @@ class SublayerConnection(nn.Module):
         self.norm = LayerNorm(size)
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, x, sublayer):
+    def forward(self, x, sublayer, *args):
         "Apply residual connection to any sublayer with the same size."
-        return x + self.dropout(sublayer(self.norm(x)))
+        return x + self.dropout(sublayer(self.norm(x), *args))
     
     
 class EncoderLayer(nn.Module):
@@ -46,12 +59,15 @@ class EncoderLayer(nn.Module):
         super(EncoderLayer, self).__init__()
         self.self_attn = self_attn
         self.feed_forward = feed_forward
-        self.sublayer = clones(SublayerConnection(size, dropout), 2)
+        self.sublayer = clones(lambda: SublayerConnection(size, dropout), 2)
         self.size = size
 
-    def forward(self, x, mask):
-        "Follow Figure 1 (left) for connections."
-        x = self.sublayer[0](x, lambda x: self.self_attn(x, x, x, mask))
+    def self_attn_block(self, x, mask, bias):
+        return self.self_attn(x, x, x, mask, bias=bias)
+
+    def forward(self, x, mask, bias=None):
+        "Follow Figure 1 (left) for connections. bias: attn_bias() of the mask, given instead of it."
+        x = self.sublayer[0](x, self.self_attn_block, mask, bias)
         return self.sublayer[1](x, self.feed_forward)
     
     
@@ -64,16 +80,47 @@ class DecoderLayer(nn.Module):
         self.self_attn = self_attn
         self.src_attn = src_attn
         self.feed_forward = feed_forward
-        self.sublayer = clones(SublayerConnection(size, dropout), 3)
+        self.sublayer = clones(lambda: SublayerConnection(size, dropout), 3)
+
+    def self_attn_block(self, x, tgt_mask, tgt_bias, cache):
+        return self.self_attn(x, x, x, tgt_mask, cache, bias=tgt_bias)
+
+    def src_attn_block(self, x, memory, src_mask, src_bias):
+        return self.src_attn(x, memory, memory, src_mask, bias=src_bias)
 
-    def forward(self, x, memory, src_mask, tgt_mask):
-        m = memory
-        x = self.sublayer[0](x, lambda x: self.self_attn(x, x, x, tgt_mask))
-        x = self.sublayer[1](x, lambda x: self.src_attn(x, m, m, src_mask))
+    def forward(self, x, memory, src_mask, tgt_mask, kv_cache=None, src_bias=None, tgt_bias=None):
+        """
+        kv_cache: None, or this layer's entry of Decoder.init_cache() when decoding step by step.
+        src_bias / tgt_bias: attn_bias() of src_mask / tgt_mask, given instead of them.
+        """
+        if kv_cache is None:
+            x = self.sublayer[0](x, self.self_attn_block, tgt_mask, tgt_bias, None)
+            x = self.sublayer[1](x, self.src_attn_block, memory, src_mask, src_bias)
+        else:
+            x = self.sublayer[0](x, self.self_attn_block, tgt_mask, tgt_bias, kv_cache["self_attn"])
+            mem_k, mem_v = kv_cache["memory_kv"]
+            x = self.sublayer[1](x, self.src_attn.forward_with_kv, mem_k, mem_v, src_mask, src_bias)
         return self.sublayer[2](x, self.feed_forward)
     
     
-def attention(query, key, value, mask=None, dropout=None):
+def attn_bias(mask, dtype):
+    """
+    Turn a mask (0 / False = masked out) into an additive attention bias.
+    The most negative finite value is used rather than -inf, so that a fully
+    masked row gives a uniform distribution instead of NaN.
+    """
+    bias = torch.zeros(mask.shape, dtype=dtype, device=mask.device)
+    return bias.masked_fill(mask == 0, torch.finfo(dtype).min)
+
+
+def attn_dtype(x):
+    "dtype attention computes in for inputs x: the autocast dtype if enabled, else x.dtype."
+    if torch.is_autocast_enabled(x.device.type):
+        return torch.get_autocast_dtype(x.device.type)
+    return x.dtype
+
+
+def attention(query, key, value, mask=None, dropout=None, training=True):
     "Compute 'Scaled Dot Product Attention'"
     """
     Parameters:
@@ -84,7 +131,8 @@ def attention(query, key, value, mask=None, dropout=None):
         mask (used in q1.3): None or torch.tensor of size (N, Lk)
          (for encoder self-attention or encoder-decoder attention)
           or (N, Lq, Lk) (for decoder self-attention)
-        dropout (used in q1.3): None or nn.Dropout()
+        dropout (used in q1.3): None or float, dropout probability
+        training: bool, dropout is only applied when True
         
     Returns:
         attn_out: Output, size (N, Lq, d_v)
@@ -93,36 +141,78 @@ def attention(query, key, value, mask=None, dropout=None):
     """
 
     keyT = torch.transpose(key,1,2)
-    dk = key.shape[2]
-    attn_weights = torch.matmul(query, keyT)/(torch.sqrt(torch.tensor(dk)))        
-    if mask is not None and len(mask.shape)==3:           
-      attn_weights = attn_weights.masked_fill(mask == 0, -1e9)       
-    elif mask is not None and len(mask.shape)==2:      
-      mask = mask.unsqueeze(1)      
-      Lq = key.shape[1]
-      mask = mask.repeat([1,Lq,1])
-      attn_weights = attn_weights.masked_fill(mask == 0, -1e9) 
-    softmax = torch.nn.Softmax(dim=2)
-    attn_weights = softmax(attn_weights)      
+    scale = key.shape[2] ** -0.5
+    attn_weights = torch.matmul(query, keyT) * scale
+    if mask is not None:
+      if len(mask.shape)==2:
+        mask = mask.unsqueeze(1) #(N, 1, Lk) broadcasts over Lq
+      attn_weights = attn_weights + attn_bias(mask, attn_weights.dtype)
+    attn_weights = F.softmax(attn_weights, dim=-1)
     if dropout is not None:
-      dropout = torch.nn.Dropout(p=dropout)
-      attn_weights = dropout(attn_weights)
+      attn_weights = F.dropout(attn_weights, p=dropout, training=training)
     attn_out = torch.matmul(attn_weights, value)    
     return attn_out, attn_weights    
 
+
+# Fused kernels first; the math backend is only picked when neither of them
+# supports the inputs (e.g. an old GPU or an unsupported head size).
+SDPA_BACKENDS = [
+    SDPBackend.FLASH_ATTENTION,
+    SDPBackend.EFFICIENT_ATTENTION,
+    SDPBackend.MATH,
+]
+
+
 class MultiHeadedAttention(nn.Module):
-    def __init__(self, h, d_model, dropout=0.1):
+    def __init__(self, h, d_model, dropout=0.1, store_attn=False):
         "Take in model size and number of heads."
         super(MultiHeadedAttention, self).__init__()
         assert d_model % h == 0
         # We assume d_v always equals d_k (since that is true in transformers)
         self.d_k = d_model // h #single head dimension
         self.h = h
-        self.linears = clones(nn.Linear(d_model, d_model), 4)
+        self.scale = 1.0 / math.sqrt(self.d_k)
+        # Q, K and V projections stacked into one weight so that they can be
+        # computed with a single GEMM when their inputs are shared.
+        self.qkv = nn.Linear(d_model, 3 * d_model)
+        self.out = nn.Linear(d_model, d_model)
+        # The fused attention kernels never materialize the attention weights,
+        # so they are only computed (and kept in self.attn) when debugging.
+        self.store_attn = store_attn
         self.attn = None
         self.dropout = nn.Dropout(p=dropout)
 
-    def forward(self, query, key, value, mask=None):
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints saved before the projections were fused use linears.0-3
+        if prefix + "linears.0.weight" in state_dict:
+            for name in ("weight", "bias"):
+                state_dict[prefix + "qkv." + name] = torch.cat(
+                    [state_dict.pop("%slinears.%d.%s" % (prefix, i, name)) for i in range(3)]
+                )
+                state_dict[prefix + "out." + name] = state_dict.pop(
+                    "%slinears.3.%s" % (prefix, name)
+                )
+        super(MultiHeadedAttention, self)._load_from_state_dict(
+            state_dict, prefix, *args, **kwargs
+        )
+
+    def reset_qkv(self):
+        "Xavier init of the Q, K and V blocks of qkv as three separate d_model x d_model linears."
+        for weight in self.qkv.weight.data.chunk(3):
+            nn.init.xavier_uniform_(weight)
+
+    def project(self, x, first, count):
+        """
+        Apply `count` consecutive Q/K/V projections, starting at `first`, in one
+        GEMM and return them already split into heads: (N, h, L, d_k) each.
+        """
+        d_model = self.h * self.d_k
+        rows = slice(first * d_model, (first + count) * d_model)
+        x = F.linear(x, self.qkv.weight[rows], self.qkv.bias[rows])
+        x = x.view(x.shape[0], x.shape[1], count, self.h, self.d_k)
+        return x.permute(2, 0, 3, 1, 4).unbind(0)
+
+    def forward(self, query, key, value, mask=None, cache=None, bias=None):
         "Implement forward pass of multi-headed attention"
         """
         Parameters:
@@ -132,10 +222,16 @@ class MultiHeadedAttention(nn.Module):
             value: torch.tensor of size (N, Lk, d_model)
             mask: None or torch.tensor of size (N, 1, Lk)
                 (for encoder self-attention or encoder-decoder attention)
-                or (N, Lq, Lk) (for decoder self-attention)
+                or (N, Lq, Lk) (for decoder self-attention).
+                0 = masked out, whatever the dtype (as in attention())
+            cache: None or dict, used for self-attention when decoding one
+                step at a time: the projected keys/values of the new
+                positions are appended to it.
+            bias: None or the additive bias attn_bias(mask) given instead of
+                mask, so that it can be computed once and shared by layers.
 
        
-        Set variable value:
+        Set variable value (only when self.store_attn is set):
             self.attn to attention values: size (N, h, Lq, Lk)
 
         Returns:
@@ -143,30 +239,60 @@ class MultiHeadedAttention(nn.Module):
 
         """                
         #first, let's split them to individual heads        
+        if query is key and key is value:
+            query, key, value = self.project(query, 0, 3) #self-attention
+            if cache is not None:
+                if "key" in cache:
+                    key = torch.cat([cache["key"], key], dim=2)
+                    value = torch.cat([cache["value"], value], dim=2)
+                cache["key"], cache["value"] = key, value
+        elif key is value:
+            query, = self.project(query, 0, 1)
+            key, value = self.precompute_kv(key) #encoder-decoder attention
+        else:
+            query, = self.project(query, 0, 1)
+            key, = self.project(key, 1, 1)
+            value, = self.project(value, 2, 1)
+        return self.attend(query, key, value, mask, bias)
+
+    def precompute_kv(self, memory):
+        "Project memory (N, Lk, d_model) to keys and values, (N, h, Lk, d_k) each."
+        return self.project(memory, 1, 2)
+
+    def forward_with_kv(self, query, key, value, mask=None, bias=None):
+        "Like forward, for keys/values already projected by precompute_kv()."
+        query, = self.project(query, 0, 1)
+        return self.attend(query, key, value, mask, bias)
+
+    def attend(self, query, key, value, mask, bias):
+        "Attention over projected, head-split query/key/value, followed by the output projection."
         N = query.shape[0]
-        Lq = query.shape[1]
-        Lk = key.shape[1]
-        query = (self.linears[0])(query).contiguous().view(N, Lq, self.h, self.d_k )
-        query = query.transpose(1,2)
-        key = (self.linears[1])(key).contiguous().view(N, Lk, self.h, self.d_k )
-        key = key.transpose(1,2)
-        value = (self.linears[2])(value).contiguous().view(N, Lk, self.h, self.d_k )
-        value = value.transpose(1,2)
-        keyT = key.transpose(2,3)
-        attn_weights = torch.matmul(query, keyT)/(torch.sqrt(torch.tensor(self.d_k))) #fin:just check the dimension in notebook
-        if mask is not None and len(mask.shape)==3:
-          mask = mask.unsqueeze(1).repeat(1,self.h,1,1) #unsqueeze at head dimension and repeat
-          if mask.shape[2] == 1:            
-            mask = mask.repeat(1,1,Lq,1)          
-          attn_weights = attn_weights.masked_fill(mask == 0, -1e9) 
-        softmax = nn.Softmax(dim=3)
-        attn_weights = softmax(attn_weights)                       
-        attn_weights = self.dropout(attn_weights) #try printing attn_weights of one row
-        self.attn = attn_weights
-        attn_out = torch.matmul(attn_weights, value)    
-        attn_out = attn_out.transpose(1,2) #transpoes back to make the self.head go in the last       
-        attn_out = attn_out.contiguous().view(N, -1, self.h * self.d_k)                        
-        x = (self.linears[3])(attn_out)        
+        if mask is not None:
+            assert bias is None, "give either a mask or a bias, not both"
+            bias = attn_bias(mask, query.dtype)
+        elif bias is not None and bias.dtype != query.dtype:
+            # clamp so that the bias stays finite when cast to a narrower dtype
+            bias = bias.clamp(min=torch.finfo(query.dtype).min).to(query.dtype)
+        mask = None if bias is None else bias.unsqueeze(1) #(N, 1, 1 or Lq, Lk) broadcasts over heads and Lq
+        if not self.store_attn:
+            with sdpa_kernel(SDPA_BACKENDS):
+                attn_out = F.scaled_dot_product_attention(
+                    query, key, value, attn_mask=mask,
+                    dropout_p=self.dropout.p if self.training else 0.0,
+                    scale=self.scale,
+                )
+        else:
+            keyT = key.transpose(2,3)
+            attn_weights = torch.matmul(query, keyT) * self.scale
+            if mask is not None:
+              attn_weights = attn_weights + mask
+            attn_weights = F.softmax(attn_weights, dim=-1)
+            attn_weights = self.dropout(attn_weights) #try printing attn_weights of one row
+            self.attn = attn_weights
+            attn_out = torch.matmul(attn_weights, value)    
+        #transpose back to make the heads go in the last dimension, copies only if needed
+        attn_out = attn_out.transpose(1,2).reshape(N, -1, self.h * self.d_k)
+        x = self.out(attn_out)
         return x
     
     
@@ -180,7 +306,8 @@ class PositionwiseFeedForward(nn.Module):
         self.dropout = nn.Dropout(dropout)
 
     def forward(self, x):
-        return self.w_2(self.dropout(self.w_1(x).relu()))
+        # ReLU in place on the fresh w_1 output: no second d_ff activation
+        return self.w_2(self.dropout(F.relu(self.w_1(x), inplace=True)))
     
     
 class Embeddings(nn.Module):
@@ -200,8 +327,12 @@ class Generator(nn.Module):
         super(Generator, self).__init__()
         self.proj = nn.Linear(d_model, vocab)
 
+    def logits(self, x):
+        "Unnormalized scores, enough when only the argmax is needed."
+        return self.proj(x)
+
     def forward(self, x):
-        return log_softmax(self.proj(x), dim=-1)
+        return F.log_softmax(self.proj(x), dim=-1)
 
     
 
@@ -210,23 +341,28 @@ class LabelSmoothing(nn.Module):
 
     def __init__(self, size, padding_idx, smoothing=0.0):
         super(LabelSmoothing, self).__init__()
-        self.criterion = nn.KLDivLoss(reduction="sum")
         self.padding_idx = padding_idx
         self.confidence = 1.0 - smoothing
         self.smoothing = smoothing
         self.size = size
-        self.true_dist = None
+        # The smoothed target puts `confidence` on the true word, 0 on the
+        # padding word and `fill` on each of the other size - 2 words.
+        self.fill = smoothing / (size - 2)
+        self.neg_entropy = 0.0 # sum of t * log(t) over that distribution
+        if self.confidence > 0:
+            self.neg_entropy += self.confidence * math.log(self.confidence)
+        if smoothing > 0:
+            self.neg_entropy += smoothing * math.log(self.fill)
 
     def forward(self, x, target):
+        """
+        Summed KL divergence between the smoothed target and exp(x), computed
+        in closed form without building the (N, size) target distribution.
+        Rows whose target is padding do not contribute.
+        """
         assert x.size(1) == self.size
-        true_dist = x.data.clone()
-        true_dist.fill_(self.smoothing / (self.size - 2))
-        true_dist.scatter_(1, target.data.unsqueeze(1), self.confidence)
-        true_dist[:, self.padding_idx] = 0
-        mask = torch.nonzero(target.data == self.padding_idx)
-        if mask.dim() > 0:
-            true_dist.index_fill_(0, mask.squeeze(), 0.0)
-        self.true_dist = true_dist
-        return self.criterion(x, true_dist.clone().detach())    
-
-    
\ No newline at end of file
+        x = x.float() #keep the loss in fp32 under autocast
+        x_target = x.gather(1, target.unsqueeze(1)).squeeze(1)
+        x_rest = x.sum(dim=1) - x_target - x[:, self.padding_idx]
+        loss = self.neg_entropy - self.confidence * x_target - self.fill * x_rest
+        return loss.masked_fill(target == self.padding_idx, 0.0).sum()
@@ -1,5 +1,4 @@
 import argparse
-import copy
 import math
 import os
 import time
@@ -33,15 +32,20 @@ def create_model(
     src_vocab, tgt_vocab, N=6, d_model=512, d_ff=2048, h=8, dropout=0.1
 ):
     "Helper: Construct a model from hyperparameters."
-    c = copy.deepcopy
-    attn = MultiHeadedAttention(h, d_model)
-    ff = PositionwiseFeedForward(d_model, d_ff, dropout)
-    position = PositionalEncoding(d_model, dropout)
+    def attn():
+        return MultiHeadedAttention(h, d_model)
+
+    def ff():
+        return PositionwiseFeedForward(d_model, d_ff, dropout)
+
+    def position():
+        return PositionalEncoding(d_model, dropout)
+
     model = EncoderDecoder(
-        Encoder(EncoderLayer(d_model, c(attn), c(ff), dropout), N),
-        Decoder(DecoderLayer(d_model, c(attn), c(attn), c(ff), dropout), N),
-        nn.Sequential(Embeddings(d_model, src_vocab), c(position)),
-        nn.Sequential(Embeddings(d_model, tgt_vocab), c(position)),
+        Encoder(lambda: EncoderLayer(d_model, attn(), ff(), dropout), N),
+        Decoder(lambda: DecoderLayer(d_model, attn(), attn(), ff(), dropout), N),
+        nn.Sequential(Embeddings(d_model, src_vocab), position()),
+        nn.Sequential(Embeddings(d_model, tgt_vocab), position()),
         Generator(d_model, tgt_vocab),
     )
 
@@ -49,6 +53,10 @@ def create_model(
     for p in model.parameters():
         if p.dim() > 1:
             nn.init.xavier_uniform_(p)
+    # ... with the fans of the separate projections for the fused Q/K/V weights
+    for module in model.modules():
+        if isinstance(module, MultiHeadedAttention):
+            module.reset_qkv()
     return model
 
 
@@ -70,9 +78,7 @@ class Batch:
     def make_std_mask(tgt, pad):
         "Create a mask to hide padding and future words."
         tgt_mask = (tgt != pad).unsqueeze(-2)
-        tgt_mask = tgt_mask & subsequent_mask(tgt.size(-1)).type_as(
-            tgt_mask.data
-        )
+        tgt_mask = tgt_mask & subsequent_mask(tgt.size(-1), tgt.device)
         return tgt_mask
     
     
@@ -103,13 +109,14 @@ def run_epoch(
     n_accum = 0
     for i, batch in enumerate(data_iter):
         
-        # Forward Pass
-        out = model.forward(
-            batch.src, batch.tgt, batch.src_mask, batch.tgt_mask
-        )
-        
-        # Compute loss
-        loss, loss_node = loss_compute(out, batch.tgt_y, batch.ntokens)
+        with mixed_precision(batch.src.device):
+            # Forward Pass
+            out = model.forward(
+                batch.src, batch.tgt, batch.src_mask, batch.tgt_mask
+            )
+            
+            # Compute loss
+            loss, loss_node = loss_compute(out, batch.tgt_y, batch.ntokens)
 
         if mode == "train":
             # Backward pass
@@ -274,11 +281,16 @@ def create_dataloaders(
     train_iter_map = to_map_style_dataset(train_iter)
     valid_iter_map = to_map_style_dataset(valid_iter)
 
+    # Group training sentences of similar length (whitespace word counts are
+    # a cheap proxy for the tokenized lengths) to cut down on padding
+    train_lengths = [
+        max(len(src.split()), len(tgt.split())) for src, tgt in train_iter_map
+    ]
+
     # Create dataloaders to iterate over datasets
     train_dataloader = DataLoader(
         train_iter_map,
-        batch_size=batch_size,
-        shuffle=True,
+        batch_sampler=BucketBatchSampler(train_lengths, batch_size),
         collate_fn=collate_fn,
     )
     valid_dataloader = DataLoader(
@@ -305,6 +317,14 @@ def train_worker(
     model = create_model(len(vocab_src), len(vocab_tgt), N=6)
     model.cuda(gpu)
     module = model
+    if args.compile:
+        # Fall back to eager for anything dynamo fails on instead of aborting
+        torch._dynamo.config.suppress_errors = True
+        # No CUDA graphs ("reduce-overhead"): batches are padded only to their
+        # own longest sentence, so nearly every batch has a new shape and
+        # would record a new graph. In the default mode the sequence lengths
+        # become dynamic after the first recompile instead.
+        model = torch.compile(model, mode="default", fullgraph=False)
 
     criterion = LabelSmoothing(
         size=len(vocab_tgt), padding_idx=pad_idx, smoothing=0.1
@@ -510,6 +530,7 @@ if __name__ == "__main__":
     parser.add_argument("--file_prefix", type=str, default="multi30k_model_", help="file prefix to use for saving")
     parser.add_argument("--beam_search", action="store_true", help="Use beam search decoding instead of greedy decoding")
     parser.add_argument("--beam_size", type=int, default=4, help="Beam size during beam search decoding")
+    parser.add_argument("--compile", action="store_true", help="Compile the model with torch.compile for training")
     
     args = parser.parse_args()
     
@@ -518,6 +539,8 @@ if __name__ == "__main__":
     torch.cuda.manual_seed_all(args.seed)
     torch.backends.cudnn.benchmark = False
     torch.backends.cudnn.deterministic = True
+    # TF32 for the matmuls left in fp32 outside of autocast
+    torch.set_float32_matmul_precision("high")
     
     spacy_de, spacy_en = load_tokenizers()
     vocab_src, vocab_tgt = load_vocab(spacy_de, spacy_en)
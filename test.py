@@ -27,10 +27,14 @@ def test_attention():
     assert torch.allclose(attn[:, :, -1], torch.zeros_like(attn[:, :, -1])), print("Attention weights are incorrectly masked")
     print("=" * 10 + "   Attention Unit Test 3 Passed   " + "="*10)
     
+    out, attn = attention(query, key, value, mask=torch.zeros(3, 10))
+    assert torch.isfinite(out).all() and torch.allclose(attn, torch.full_like(attn, 0.1)), print("Fully masked rows should attend uniformly")
+    print("=" * 10 + "   Attention Unit Test 4 Passed   " + "="*10)
+    
 
 def test_multiheaded_attention():
     
-    from layers import MultiHeadedAttention
+    from layers import MultiHeadedAttention, attn_bias
     
     d_k = 16
     d_v = 16
@@ -38,7 +42,7 @@ def test_multiheaded_attention():
     key = torch.rand(3, 10, d_k)
     query = torch.rand(3, 10, d_k)
     value = torch.rand(3, 10, d_v)
-    mattn = MultiHeadedAttention(h, d_k, dropout=0)
+    mattn = MultiHeadedAttention(h, d_k, dropout=0, store_attn=True)
     out = mattn(query, key, value)
     
     assert out.shape == value.shape, print("Incorrect shape of output")
@@ -53,6 +57,41 @@ def test_multiheaded_attention():
     assert torch.allclose(sum_attn, torch.ones_like(sum_attn).type_as(sum_attn)), print("Incorrect attention weights", sum_attn)
     print("=" * 10 + "   Multiheaded Attention Unit Test 3 Passed   " + "="*10)
     
+    mask = torch.ones(3, 1, 10, dtype=torch.bool)
+    mask[:, :, -1] = False
+    mattn.store_attn = False
+    fused_out = mattn(query, key, value, mask)
+    mattn.store_attn = True
+    assert torch.allclose(fused_out, mattn(query, key, value, mask), atol=1e-6), print("Fused attention does not match the reference")
+    print("=" * 10 + "   Multiheaded Attention Unit Test 4 Passed   " + "="*10)
+    
+    mask = torch.zeros(3, 1, 10, dtype=torch.bool)
+    assert torch.isfinite(mattn(query, key, value, mask)).all(), print("Fully masked rows should not give NaN")
+    mattn.store_attn = False
+    assert torch.isfinite(mattn(query, key, value, mask)).all(), print("Fully masked rows should not give NaN")
+    print("=" * 10 + "   Multiheaded Attention Unit Test 4b Passed   " + "="*10)
+    
+    # A 0/1 float mask masks like a bool one, as in attention()
+    mask = torch.ones(3, 1, 10)
+    mask[:, :, -3:] = 0
+    expected = mattn(query, key, value, mask.bool())
+    assert torch.allclose(mattn(query, key, value, mask), expected, atol=1e-6), print("Float masks should mask like bool masks")
+    bias = attn_bias(mask, torch.float32)
+    assert torch.allclose(mattn(query, key, value, bias=bias), expected, atol=1e-6), print("Precomputed bias does not match the mask")
+    print("=" * 10 + "   Multiheaded Attention Unit Test 4c Passed   " + "="*10)
+    
+    # Q/K/V blocks of the fused weight get the init of a standalone d_model x d_model linear
+    d_model = 64
+    mattn = MultiHeadedAttention(h, d_model)
+    torch.nn.init.xavier_uniform_(mattn.qkv.weight)
+    mattn.reset_qkv()
+    linear = torch.nn.Linear(d_model, d_model)
+    torch.nn.init.xavier_uniform_(linear.weight)
+    bound = linear.weight.abs().max()
+    for weight in mattn.qkv.weight.data.chunk(3):
+        assert torch.isclose(weight.abs().max(), bound, rtol=0.05), print("Incorrect init of the fused Q/K/V weights")
+    print("=" * 10 + "   Multiheaded Attention Unit Test 5 Passed   " + "="*10)
+    
 
 def test_positional_encoding():
     
@@ -67,6 +106,87 @@ def test_positional_encoding():
     print("=" * 10 + "   Positional Encoding Unit Test 1 Passed   " + "="*10)
     
     
+def test_kv_cache_decoding():
+    
+    from layers import (Embeddings, Generator, MultiHeadedAttention, PositionwiseFeedForward,
+                        EncoderLayer, DecoderLayer)
+    from transformer import EncoderDecoder, Encoder, Decoder
+    from utils import PositionalEncoding, greedy_decode, beam_search_decode, subsequent_mask
+    
+    vocab, d_model, d_ff, h = 37, 32, 64, 4
+    
+    def make_model():
+        model = EncoderDecoder(
+            Encoder(lambda: EncoderLayer(d_model, MultiHeadedAttention(h, d_model),
+                                         PositionwiseFeedForward(d_model, d_ff), 0.1), 2),
+            Decoder(lambda: DecoderLayer(d_model, MultiHeadedAttention(h, d_model), MultiHeadedAttention(h, d_model),
+                                         PositionwiseFeedForward(d_model, d_ff), 0.1), 2),
+            torch.nn.Sequential(Embeddings(d_model, vocab), PositionalEncoding(d_model, 0.1)),
+            torch.nn.Sequential(Embeddings(d_model, vocab), PositionalEncoding(d_model, 0.1)),
+            Generator(d_model, vocab),
+        )
+        for p in model.parameters():
+            if p.dim() > 1:
+                torch.nn.init.xavier_uniform_(p)
+        return model.eval()
+    
+    # Reference decoders re-running the decoder over the full prefix at every step
+    def full_prefix_greedy(model, src, src_mask, max_len, start_symbol):
+        memory = model.encode(src, src_mask)
+        ys = torch.full((1, 1), start_symbol, dtype=src.dtype)
+        for i in range(max_len - 1):
+            out = model.decode(memory, src_mask, ys, subsequent_mask(ys.size(1)))
+            next_word = model.generator(out[:, -1]).argmax(dim=-1)
+            ys = torch.cat([ys, next_word.unsqueeze(1)], dim=1)
+        return ys
+    
+    def full_prefix_beam(model, src, src_mask, max_len, start_symbol, beam_size, end_idx):
+        memory = model.encode(src, src_mask)
+        ys = torch.full((1, 1), start_symbol, dtype=src.dtype)
+        scores = torch.zeros(1)
+        for i in range(max_len - 1):
+            out = model.decode(memory, src_mask, ys, subsequent_mask(ys.size(1)))
+            prob = model.generator(out[:, -1])
+            prob[ys[:, -1] == end_idx, :] = 0
+            combined = prob if i == 0 else scores.unsqueeze(1) + prob
+            scores, k_indices = torch.topk(combined.flatten(), beam_size)
+            rows = k_indices // combined.size(1)
+            cols = k_indices % combined.size(1)
+            new_tokens = torch.where(prob[rows, cols] == 0, torch.tensor(end_idx), cols)
+            ys = torch.cat([ys[rows], new_tokens.unsqueeze(1)], dim=1)
+            if (ys[:, -1] == end_idx).all():
+                break
+            if i == 0:
+                memory = memory.expand(beam_size, *memory.shape[1:])
+                src_mask = src_mask.expand(beam_size, *src_mask.shape[1:])
+        return ys[scores.argmax()].unsqueeze(0)
+    
+    greedy_match, beam_match = True, True
+    with torch.no_grad():
+        for seed in range(10):
+            torch.manual_seed(seed)
+            model = make_model()
+            src = torch.randint(3, vocab, (1, 9))
+            src[0, 0] = 0
+            src[0, -2:] = 2
+            src_mask = (src != 2).unsqueeze(-2)
+            
+            ys = full_prefix_greedy(model, src, src_mask, 12, 0)
+            greedy_match &= torch.equal(ys, greedy_decode(model, src, src_mask, 12, 0))
+            
+            # Use a token the model actually emits as end symbol, so finished beams occur
+            end_idx = int(ys[0, 3])
+            for beam_size in (1, 2, 4):
+                expected = full_prefix_beam(model, src, src_mask, 12, 0, beam_size, end_idx)
+                beam_match &= torch.equal(expected, beam_search_decode(model, src, src_mask, 12, 0, beam_size, end_idx))
+    
+    assert greedy_match, print("Greedy decoding with the KV cache does not match full-prefix decoding")
+    print("=" * 10 + "   KV Cache Decoding Unit Test 1 Passed   " + "="*10)
+    
+    assert beam_match, print("Beam search with the KV cache does not match full-prefix decoding")
+    print("=" * 10 + "   KV Cache Decoding Unit Test 2 Passed   " + "="*10)
+    
+    
 def test_beam_search():
     
     from main import eval_model, load_tokenizers, load_vocab, create_dataloaders, create_model
@@ -123,6 +243,7 @@ if __name__ == "__main__":
     parser.add_argument("--multiheaded_attention", action="store_true", help="unit test for mulitheaded attn")
     parser.add_argument("--positional_encoding", action="store_true", help="unit test for positional encoding")
     parser.add_argument("--beam_search", action="store_true", help="unit tests for beam search")
+    parser.add_argument("--kv_cache", action="store_true", help="unit tests for KV-cached greedy and beam search decoding")
     
     args = parser.parse_args()
     
@@ -141,6 +262,9 @@ if __name__ == "__main__":
     if args.positional_encoding:
         test_positional_encoding()
         
+    if args.kv_cache:
+        test_kv_cache_decoding()
+        
     if args.beam_search:
         test_beam_search()
     
\ No newline at end of file
@@ -25,36 +25,64 @@ class EncoderDecoder(nn.Module):
     def encode(self, src, src_mask):
         return self.encoder(self.src_embed(src), src_mask)
 
-    def decode(self, memory, src_mask, tgt, tgt_mask):
-        return self.decoder(self.tgt_embed(tgt), memory, src_mask, tgt_mask)
+    def decode(self, memory, src_mask, tgt, tgt_mask, kv_cache=None, offset=0, src_bias=None):
+        """
+        When decoding step by step, tgt only holds the new tokens, which start
+        at position `offset`; the decoder keeps the keys/values of the earlier
+        positions in kv_cache (one dict per layer). src_bias: attn_bias() of
+        src_mask, given instead of it so that it is built once per sentence.
+        """
+        if kv_cache is None:
+            return self.decoder(self.tgt_embed(tgt), memory, src_mask, tgt_mask, src_bias=src_bias)
+        embed, position = self.tgt_embed
+        x = position(embed(tgt), offset)
+        return self.decoder(x, memory, src_mask, tgt_mask, kv_cache, src_bias)
     
     
     
 class Encoder(nn.Module):
-    "Core encoder is a stack of N layers"
+    "Core encoder is a stack of N layers, each built by calling layer()"
 
     def __init__(self, layer, N):
         super(Encoder, self).__init__()
         self.layers = clones(layer, N)
-        self.norm = LayerNorm(layer.size)
+        self.norm = LayerNorm(self.layers[0].size)
 
     def forward(self, x, mask):
         "Pass the input (and mask) through each layer in turn."
+        #converted once, shared by all layers, in the dtype attention runs in (bf16 under autocast)
+        bias = None if mask is None else attn_bias(mask, attn_dtype(x))
         for layer in self.layers:
-            x = layer(x, mask)
+            x = layer(x, None, bias)
         return self.norm(x)
     
 
     
 class Decoder(nn.Module):
-    "Generic N layer decoder with masking."
+    "Generic N layer decoder with masking, each layer built by calling layer()"
 
     def __init__(self, layer, N):
         super(Decoder, self).__init__()
         self.layers = clones(layer, N)
-        self.norm = LayerNorm(layer.size)
+        self.norm = LayerNorm(self.layers[0].size)
 
-    def forward(self, x, memory, src_mask, tgt_mask):
-        for layer in self.layers:
-            x = layer(x, memory, src_mask, tgt_mask)
+    def init_cache(self, memory):
+        """
+        State for decoding step by step, one dict per layer: the encoder-decoder
+        attention keys/values of memory, projected once, and the (initially
+        empty) self-attention cache.
+        """
+        return [
+            {"memory_kv": layer.src_attn.precompute_kv(memory), "self_attn": {}}
+            for layer in self.layers
+        ]
+
+    def forward(self, x, memory, src_mask, tgt_mask, kv_cache=None, src_bias=None):
+        "Masks are converted to biases once, shared by all layers, as in Encoder."
+        if src_mask is not None:
+            src_bias = attn_bias(src_mask, attn_dtype(x))
+        tgt_bias = None if tgt_mask is None else attn_bias(tgt_mask, attn_dtype(x))
+        for i, layer in enumerate(self.layers):
+            layer_cache = None if kv_cache is None else kv_cache[i]
+            x = layer(x, memory, None, None, layer_cache, src_bias, tgt_bias)
         return self.norm(x)    
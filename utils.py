@@ -1,10 +1,9 @@
-import copy
 import math
 
 import sacrebleu
 import torch
 import torch.nn as nn
-from torch.nn.functional import pad
+from torch.nn.utils.rnn import pad_sequence
 
 
 ## Dummy functions defined to use the same function run_epoch() during eval
@@ -24,17 +23,22 @@ class DummyScheduler:
     def step(self):
         None
         
-def clones(module, N):
-    "Produce N identical layers."
-    return nn.ModuleList([copy.deepcopy(module) for _ in range(N)])
+def clones(factory, N):
+    "Produce N identical layers, each built by calling factory()."
+    return nn.ModuleList([factory() for _ in range(N)])
 
-def subsequent_mask(size):
+# Largest subsequent mask built so far on each device; calls slice views of it
+_subsequent_masks = {}
+
+
+def subsequent_mask(size, device="cpu"):
     "Mask out subsequent positions."
-    attn_shape = (1, size, size)
-    subsequent_mask = torch.triu(torch.ones(attn_shape), diagonal=1).type(
-        torch.uint8
-    )
-    return subsequent_mask == 0
+    device = torch.device(device)
+    mask = _subsequent_masks.get(device)
+    if mask is None or mask.size(0) < size:
+        mask = torch.ones(size, size, dtype=torch.bool, device=device).tril()
+        _subsequent_masks[device] = mask
+    return mask[:size, :size].unsqueeze(0)
 
 
 def rate(step, model_size, factor, warmup):
@@ -49,6 +53,14 @@ def rate(step, model_size, factor, warmup):
     )
 
 
+def mixed_precision(device):
+    "bf16 autocast context for the model's forward on GPU, a no-op elsewhere."
+    device = torch.device(device)
+    return torch.autocast(
+        device_type=device.type, dtype=torch.bfloat16, enabled=device.type == "cuda"
+    )
+
+
 
 class PositionalEncoding(nn.Module):
     "Implement the PE function."
@@ -66,35 +78,44 @@ class PositionalEncoding(nn.Module):
             pe: torch.tensor of size (max_len, d_model)
             
         """        
-        pe = torch.zeros(max_len, d_model)        
-        for pos in range(max_len):
-          for i in range(0,int((d_model/2.0))):
-            exp_term = (2*i)/d_model
-            exp_term2 = (2*(i))/d_model 
-            pe[pos,2*i] = math.sin(pos/10000**exp_term)
-            pe[pos,(2*i)+1]= math.cos(pos/10000**exp_term2)                
+        pe = torch.zeros(max_len, d_model)
+        position = torch.arange(max_len).unsqueeze(1).float()
+        div_term = torch.exp(
+            torch.arange(0, d_model, 2).float() * -(math.log(10000.0) / d_model)
+        )
+        pe[:, 0::2] = torch.sin(position * div_term)
+        pe[:, 1::2] = torch.cos(position * div_term[: d_model // 2])
         self.register_buffer("pe", pe)
 
-    def forward(self, x):
-        pe = self.pe.unsqueeze(0)
-        x = x + pe[:, : x.size(1)].requires_grad_(False)
+    def forward(self, x, offset=0):
+        # (L, d_model) broadcasts over the batch dimension of x
+        x = x + self.pe[offset : offset + x.size(1)].requires_grad_(False)
         return self.dropout(x)     
 
 
     
 def greedy_decode(model, src, src_mask, max_len, start_symbol):
-    memory = model.encode(src, src_mask)
-    ys = torch.zeros(1, 1).fill_(start_symbol).type_as(src.data)
+    from layers import attn_bias, attn_dtype #layers imports utils
+    with mixed_precision(src.device):
+        memory = model.encode(src, src_mask)
+        # Only the newest token is fed to the decoder, the keys/values of the
+        # previous ones are kept per layer (so no subsequent mask is needed),
+        # along with the keys/values of memory which are projected only once
+        kv_cache = model.decoder.init_cache(memory)
+        # The source mask is turned into an attention bias once, not at every step
+        src_bias = attn_bias(src_mask, attn_dtype(memory))
+    # Output buffer filled in place, one token per step
+    ys = torch.full((1, max_len), start_symbol, dtype=src.dtype, device=src.device)
     for i in range(max_len - 1):
-        out = model.decode(
-            memory, src_mask, ys, subsequent_mask(ys.size(1)).type_as(src.data)
-        )
-        prob = model.generator(out[:, -1])
-        _, next_word = torch.max(prob, dim=1)
-        next_word = next_word.data[0]
-        ys = torch.cat(
-            [ys, torch.zeros(1, 1).type_as(src.data).fill_(next_word)], dim=1
-        )
+        with mixed_precision(src.device):
+            out = model.decode(
+                memory, None, ys[:, i : i + 1], None, kv_cache, offset=i,
+                src_bias=src_bias,
+            )
+            # log_softmax does not change the argmax, so it is skipped
+            logits = model.generator.logits(out[:, -1])
+        # The token stays on the device: no host sync per step
+        ys[:, i + 1] = logits.argmax(dim=-1)
     return ys
 
 
@@ -118,69 +139,80 @@ def beam_search_decode(model, src, src_mask, max_len, start_symbol, beam_size, e
     """
     
     
+    from layers import attn_bias, attn_dtype #layers imports utils
+    
+    # Everything below stays on this device: no host round trips per beam
+    device = src.device
+    
     # Output of encoder
-    memory = model.encode(src, src_mask)
+    with mixed_precision(device):
+        memory = model.encode(src, src_mask)
+        # Per layer keys/values of memory and of the tokens decoded so far, see greedy_decode
+        kv_cache = model.decoder.init_cache(memory)
+        src_bias = attn_bias(src_mask, attn_dtype(memory))
     
     # Initialize start of sequence with start symbol
-    ys = torch.zeros(1,1).fill_(start_symbol).type_as(src.data).cuda()
+    ys = torch.full((1, 1), start_symbol, dtype=src.dtype, device=device)
     
     # We will use this to store log_prob of the sequences so far
-    scores = torch.Tensor([0.]).cuda() #shape: N*bw:1 -> jsut bw sequences
+    scores = torch.zeros(1, device=device) #shape: N*bw:1 -> jsut bw sequences
+    
+    # Token written after sequences which have already finished
+    end_token = torch.tensor(end_idx, device=device)
     
     for i in range(max_len - 1):
         
-        # Compute the output using the decoder
-        out = model.decode(
-            memory, src_mask, ys, subsequent_mask(ys.size(1)).type_as(src.data)
-        )
-        
-        # Compute the log_prob for the next token
-        prob = model.generator(out[:,-1])
-        vocab_size = prob.shape[-1]
+        with mixed_precision(device):
+            # Compute the output of the newest token using the decoder
+            out = model.decode(
+                memory, None, ys[:, -1:], None, kv_cache, offset=i,
+                src_bias=src_bias,
+            )
+            
+            # Compute the log_prob for the next token
+            prob = model.generator(out[:,-1])
         
         # For sequences which have finished, set log_prob to zero
-        prob[ys[:,-1] == end_idx,:] = 0
+        # (masked_fill rather than boolean indexing, which syncs with the host)
+        prob = prob.masked_fill((ys[:, -1] == end_idx).unsqueeze(1), 0)
                         
         # 1. Combine the log_prob of next token with our scores so far.
         # since probabilities shoudl be multipled, the log_probs can be added directly
         if (i==0): #first iteration                        
             combined = prob
         else:                
-            combined = scores.unsqueeze(1).repeat(1,vocab_size) + (prob) #bw*vocabsize -> unsqueeze scores on dimension 
+            combined = scores.unsqueeze(1) + prob #bw*vocabsize, scores broadcast over the vocabulary
         #update the scores variable also
         # 2. Use these scores to construct variable ys, which is the best beam_size number of sequences so far.
         k_values, k_indices = torch.topk(combined.flatten(), beam_size)
         rows = k_indices // combined.size(1)
         cols = k_indices % combined.size(1)
         scores = k_values 
-        newys = []
-        for k in range(beam_size):
-            i = rows[k]
-            j = cols[k]
-            prev_seq = ys[i]
-            if prob[i][j] == 0:
-                new_seq = torch.cat((prev_seq, torch.tensor([end_idx]).cuda()), dim=0)
-            else:
-                new_seq = torch.cat((prev_seq, torch.tensor([j]).cuda()), dim=0)
-            if k==0:
-                newys = new_seq.unsqueeze(0)
-            else:    
-                newys = torch.cat((newys, new_seq.unsqueeze(0)), dim=0)            
         # Once a sequence has finished, all the next tokens should also be end_idx.
-        # Set value of variable:
+        # Extend all the chosen beams at once:
         #     ys: torch.tensor of shape (beam_size, current length of sequence) where current length will be i + 2.
-        ys = newys    
-        if (ys[:, -1]==end_idx).sum() == beam_size:
+        new_tokens = torch.where(prob[rows, cols] == 0, end_token, cols)
+        ys = torch.cat([ys[rows], new_tokens.unsqueeze(1)], dim=1)
+        # The self-attention caches follow the beams they were computed for
+        for layer_cache in kv_cache:
+            self_cache = layer_cache["self_attn"]
+            self_cache["key"] = self_cache["key"][rows]
+            self_cache["value"] = self_cache["value"][rows]
+        # The only host sync of the step
+        if (ys[:, -1] == end_idx).all():
             break
         # Encoder output expansion from the second time step to the beam size
         # This is needed because for the first time step we only have the start token as ys
         if i==0:
             memory = memory.expand(beam_size, *memory.shape[1:])
-            src_mask = src_mask.expand(beam_size, *src_mask.shape[1:])
+            src_bias = src_bias.expand(beam_size, *src_bias.shape[1:])
+            for layer_cache in kv_cache:
+                layer_cache["memory_kv"] = tuple(
+                    t.expand(beam_size, *t.shape[1:]) for t in layer_cache["memory_kv"]
+                )
     
     # convert the top scored sequence to a list of text tokens
-    ys, _ = max(zip(ys, scores), key=lambda x: x[1])
-    ys = ys.unsqueeze(0)
+    ys = ys[scores.argmax()].unsqueeze(0)
     
     return ys
     
@@ -195,56 +227,70 @@ def collate_batch(
     max_padding=128,
     pad_id=2,
 ):
-    bs_id = torch.tensor([0], device=device)  # <s> token id
-    eos_id = torch.tensor([1], device=device)  # </s> token id
+    bs_id = 0  # <s> token id
+    eos_id = 1  # </s> token id
     src_list, tgt_list = [], []
     for (_src, _tgt) in batch:
-        processed_src = torch.cat(
-            [
-                bs_id,
-                torch.tensor(
-                    src_vocab(src_pipeline(_src)),
-                    dtype=torch.int64,
-                    device=device,
-                ),
-                eos_id,
-            ],
-            0,
-        )
-        processed_tgt = torch.cat(
-            [
-                bs_id,
-                torch.tensor(
-                    tgt_vocab(tgt_pipeline(_tgt)),
-                    dtype=torch.int64,
-                    device=device,
-                ),
-                eos_id,
-            ],
-            0,
-        )
         src_list.append(
-            # warning - overwrites values for negative values of padding - len
-            pad(
-                processed_src,
-                (
-                    0,
-                    max_padding - len(processed_src),
-                ),
-                value=pad_id,
+            torch.tensor(
+                [bs_id] + src_vocab(src_pipeline(_src)) + [eos_id], dtype=torch.int64
             )
         )
         tgt_list.append(
-            pad(
-                processed_tgt,
-                (0, max_padding - len(processed_tgt)),
-                value=pad_id,
+            torch.tensor(
+                [bs_id] + tgt_vocab(tgt_pipeline(_tgt)) + [eos_id], dtype=torch.int64
             )
         )
 
-    src = torch.stack(src_list)
-    tgt = torch.stack(tgt_list)
-    return (src, tgt)
+    def pad_batch(seqs):
+        # Pad only up to the longest sequence of the batch, so attention and
+        # feed-forward do no work on columns that are padding everywhere.
+        # warning - sequences longer than max_padding are truncated
+        padded = pad_sequence(seqs, batch_first=True, padding_value=pad_id)
+        return padded[:, :max_padding]
+
+    # Build the batch on the CPU and move it to the device with one copy per
+    # tensor; pinned memory lets those copies run asynchronously.
+    src = pad_batch(src_list)
+    tgt = pad_batch(tgt_list)
+    if torch.device(device).type == "cuda":
+        src, tgt = src.pin_memory(), tgt.pin_memory()
+    return (src.to(device, non_blocking=True), tgt.to(device, non_blocking=True))
+
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """
+    Yield batches of indices of examples with similar lengths, which keeps
+    the padding added by collate_batch small. Indices are shuffled, split
+    into pools of `pool_size` batches and sorted by length within each pool;
+    the resulting batches are shuffled again.
+    """
+
+    def __init__(self, lengths, batch_size, pool_size=100, shuffle=True):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.pool_size = pool_size
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        if self.shuffle:
+            indices = torch.randperm(len(self.lengths)).tolist()
+        else:
+            indices = list(range(len(self.lengths)))
+        pool = self.batch_size * self.pool_size
+        batches = []
+        for start in range(0, len(indices), pool):
+            chunk = sorted(indices[start : start + pool], key=self.lengths.__getitem__)
+            batches += [
+                chunk[i : i + self.batch_size]
+                for i in range(0, len(chunk), self.batch_size)
+            ]
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        return iter(batches)
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
 
 
 def remove_start_end_tokens(sent):